@@ -0,0 +1,49 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled fast path for the hand-built audio frames in test.py.
+
+Optional: test.py falls back to its NumPy implementation when this module is
+not built. Build it in place with
+
+    CFLAGS="-O3 -march=native -funroll-loops" cythonize -i _ws_fast.pyx
+"""
+from cpython.bytes cimport PyBytes_AS_STRING, PyBytes_FromStringAndSize
+from libc.stdint cimport uint8_t
+from libc.string cimport memcpy
+
+cpdef bytes build_masked_binary_frame(const uint8_t[::1] payload, bytes key):
+    """
+    Encode payload as a final, masked, binary RFC 6455 frame using the given
+    4-byte masking key.
+    """
+    if len(key) != 4:
+        raise ValueError("masking key must be 4 bytes")
+    cdef Py_ssize_t n = payload.shape[0]
+    cdef Py_ssize_t header_len = 2 if n < 126 else 4 if n < 65536 else 10
+    cdef bytes frame = PyBytes_FromStringAndSize(NULL, header_len + 4 + n)
+    cdef uint8_t* out = <uint8_t*> PyBytes_AS_STRING(frame)
+    cdef const uint8_t* k = <const uint8_t*> PyBytes_AS_STRING(key)
+    cdef const uint8_t* src
+    cdef Py_ssize_t i
+
+    out[0] = 0x82
+    if n < 126:
+        out[1] = 0x80 | n
+    elif n < 65536:
+        out[1] = 0x80 | 126
+        out[2] = (n >> 8) & 0xFF
+        out[3] = n & 0xFF
+    else:
+        out[1] = 0x80 | 127
+        for i in range(8):
+            out[2 + i] = (n >> (8 * (7 - i))) & 0xFF
+    memcpy(out + header_len, k, 4)
+
+    if n:
+        src = &payload[0]
+        out += header_len + 4
+        # Simple enough for the C compiler to vectorize at -O3
+        with nogil:
+            for i in range(n):
+                out[i] = src[i] ^ k[i & 3]
+    return frame
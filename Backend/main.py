@@ -1,13 +1,24 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from typing import List, Dict
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, status
+from typing import Dict, Iterable, List
+import asyncio
+import logging
 import sqlite3
-import json
+import orjson
+
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
 
 app = FastAPI()
 
+INSERT_CHANNEL = "INSERT INTO channels (name) VALUES (?)"
+
 # In-memory SQLite database
 def init_db():
     conn = sqlite3.connect(":memory:", check_same_thread=False)
+    # Nothing is persisted, so durability guarantees only cost time
+    conn.execute("PRAGMA cache_size = -16000")
+    conn.execute("PRAGMA journal_mode = MEMORY")
+    conn.execute("PRAGMA synchronous = OFF")
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE channels (
@@ -15,111 +26,251 @@ def init_db():
             name TEXT UNIQUE NOT NULL
         )
     """)
-    cursor.execute("INSERT INTO channels (name) VALUES (?)", ("Default",))  
+    cursor.execute(INSERT_CHANNEL, ("Default",))
     conn.commit()
     return conn
 
 db_conn = init_db()
 
+# Channel names in creation order, kept in step with the channels table so
+# /api/channels never has to query SQLite
+channels_cache: List[str] = [row[0] for row in db_conn.execute("SELECT name FROM channels ORDER BY id")]
+
+# Audio frames buffered per listener before the oldest ones are dropped
+OUTBOUND_QUEUE_SIZE = 32
+
+# Nagle-style coalescing: audio is relayed at once unless the channel relayed a
+# frame within the last COALESCE_WINDOW seconds; frames arriving inside the
+# window are merged, up to COALESCE_MAX_BYTES, and relayed when it closes
+COALESCE_WINDOW = 0.02
+COALESCE_MAX_BYTES = 4096
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}  
+        self.active_connections: Dict[str, Dict[WebSocket, None]] = {}  
         self.channel_senders: Dict[str, WebSocket] = {}  
+        self.queues: Dict[WebSocket, asyncio.Queue] = {}
+        self.tasks: Dict[WebSocket, asyncio.Task] = {}
+        self.pending: Dict[str, bytearray] = {}
+        self.flush_handles: Dict[str, asyncio.TimerHandle] = {}
+        self.last_relayed: Dict[str, float] = {}
 
     async def connect(self, websocket: WebSocket, channel: str):
         await websocket.accept()
-        if channel not in self.active_connections:
-            self.active_connections[channel] = []
-        self.active_connections[channel].append(websocket)
-        print(f"Client connected to channel {channel}: {websocket.client}")
+        self.active_connections.setdefault(channel, {})[websocket] = None
+        self.queues[websocket] = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self.tasks[websocket] = asyncio.create_task(self._relay(websocket, channel))
+        log.info("Client connected to channel %s: %s", channel, websocket.client)
 
     def disconnect(self, websocket: WebSocket, channel: str):
-        if channel in self.active_connections:
-            self.active_connections[channel].remove(websocket)
-            if not self.active_connections[channel]:
+        task = self.tasks.pop(websocket, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+        self.queues.pop(websocket, None)
+        connections = self.active_connections.get(channel)
+        if connections is not None and websocket in connections:
+            del connections[websocket]
+            if not connections:
                 del self.active_connections[channel]  
-            if channel in self.channel_senders and self.channel_senders[channel] == websocket:
+            if self.channel_senders.get(channel) is websocket:
+                self.flush(channel, websocket)
+                self.last_relayed.pop(channel, None)
                 self.channel_senders.pop(channel)
-            print(f"Client disconnected from channel {channel}: {websocket.client}")
+            log.info("Client disconnected from channel %s: %s", channel, websocket.client)
 
-    async def broadcast(self, data: bytes, channel: str, sender: WebSocket):
+    async def _relay(self, websocket: WebSocket, channel: str):
+        queue = self.queues[websocket]
+        while True:
+            message = await queue.get()
+            try:
+                await websocket.send(message)
+            except Exception as e:
+                log.warning("Error broadcasting to %s: %s", websocket.client, e)
+                self.disconnect(websocket, channel)
+                return
+
+    def broadcast(self, data: bytes, channel: str, sender: WebSocket):
         if channel in self.active_connections:
+            # One ASGI message shared by every listener; send_bytes() would
+            # build an identical dict per listener
+            message = {"type": "websocket.send", "bytes": data}
             for connection in self.active_connections[channel]:
-                if connection != sender: 
-                    try:
-                        await connection.send_bytes(data)
-                    except Exception as e:
-                        print(f"Error broadcasting to {connection.client}: {e}")
-        print(f"Broadcasted data: {len(data)} bytes to {len(self.active_connections.get(channel, []))} clients in channel {channel}")
+                if connection is not sender:
+                    queue = self.queues[connection]
+                    if queue.full():
+                        # Keep audio real-time: drop the stalest frame rather than wait
+                        queue.get_nowait()
+                    queue.put_nowait(message)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Broadcasted data: %d bytes to %d clients in channel %s", len(data), len(self.active_connections.get(channel, {})), channel)
+
+    def coalesce(self, data: bytes, channel: str, sender: WebSocket):
+        pending = self.pending.get(channel)
+        if pending is None:
+            loop = asyncio.get_running_loop()
+            now = loop.time()
+            last = self.last_relayed.get(channel)
+            if last is None or now - last >= COALESCE_WINDOW or len(data) >= COALESCE_MAX_BYTES:
+                # Nothing relayed recently, or already a full batch: relay the
+                # received bytes object as-is
+                self.last_relayed[channel] = now
+                self.broadcast(data, channel, sender)
+                return
+            pending = self.pending[channel] = bytearray()
+            self.flush_handles[channel] = loop.call_at(last + COALESCE_WINDOW, self.flush, channel, sender)
+        pending += data
+        if len(pending) >= COALESCE_MAX_BYTES:
+            self.flush(channel, sender)
+
+    def flush(self, channel: str, sender: WebSocket):
+        handle = self.flush_handles.pop(channel, None)
+        if handle is not None:
+            handle.cancel()
+        pending = self.pending.pop(channel, None)
+        if pending:
+            self.last_relayed[channel] = asyncio.get_running_loop().time()
+            self.broadcast(bytes(pending), channel, sender)
 
     async def set_sender(self, websocket: WebSocket, channel: str):
         if channel not in self.channel_senders:
             self.channel_senders[channel] = websocket
-            print(f"Sender set for channel {channel}: {websocket.client}")
+            log.info("Sender set for channel %s: %s", channel, websocket.client)
             return True
         return False
 
     def clear_sender(self, websocket: WebSocket, channel: str):
-        if channel in self.channel_senders and self.channel_senders[channel] == websocket:
+        if self.channel_senders.get(channel) is websocket:
+            self.flush(channel, websocket)
+            self.last_relayed.pop(channel, None)
             self.channel_senders.pop(channel)
-            print(f"Sender cleared for channel {channel}: {websocket.client}")
+            log.info("Sender cleared for channel %s: %s", channel, websocket.client)
 
     async def send_message(self, message: str, websocket: WebSocket):
         try:
             await websocket.send_text(message)
         except Exception as e:
-            print(f"Error sending message to {websocket.client}: {e}")
+            log.warning("Error sending message to %s: %s", websocket.client, e)
+
+    async def send_to_all(self, message: str, connections: Iterable[WebSocket]):
+        await asyncio.gather(*(self.send_message(message, connection) for connection in connections))
 
 manager = ConnectionManager()
 
+# The declared return type lets FastAPI serialize the response with Pydantic's
+# compiled serializer instead of jsonable_encoder
 @app.get("/api/channels")
-async def get_channels():
-    cursor = db_conn.cursor()
-    cursor.execute("SELECT name FROM channels")
-    channels = [row[0] for row in cursor.fetchall()]
-    return {"channels": channels}
-
-@app.websocket("/ws/{channel}")
-async def websocket_endpoint(websocket: WebSocket, channel: str):
+async def get_channels() -> Dict[str, List[str]]:
+    return {"channels": channels_cache}
+
+SIGNALING_TYPES = frozenset(("iceCandidate", "offer", "answer"))
+# Text containing none of the quoted type names cannot be signaling, so it is
+# dropped without being parsed
+SIGNALING_MARKERS = tuple(f'"{kind}"' for kind in SIGNALING_TYPES)
+
+# WebSocket endpoints are registered as plain Starlette routes: they take no
+# validated parameters, so FastAPI's per-connection dependency solving is skipped
+async def websocket_endpoint(websocket: WebSocket):
+    channel = websocket.path_params["channel"]
     await manager.connect(websocket, channel)
     try:
-        while True:
-            try:
-                message = await websocket.receive()
-            except RuntimeError as e:
-                if "Cannot call" in str(e):
+        # The first frame fixes the socket's role: audio sockets only send bytes
+        # and signaling sockets only text, so each gets a typed receive loop.
+        # Clients that mix both use /ws/control/{channel}.
+        message = await websocket.receive()
+        if "bytes" in message:
+            data = message["bytes"]
+            # Only start/stop on the control route change the sender, so this
+            # socket's status is fixed for the lifetime of the loop
+            is_sender = manager.channel_senders.get(channel) is websocket
+            while True:
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Received data: %d bytes from %s in channel %s", len(data), websocket.client, channel)
+                    if is_sender:
+                        log.debug("Broadcasting data from sender: %s in channel %s", websocket.client, channel)
+                    else:
+                        log.debug("Received data from non-sender: %s in channel %s", websocket.client, channel)
+                if is_sender:
+                    manager.coalesce(data, channel, websocket)
+                try:
+                    data = await websocket.receive_bytes()
+                except KeyError:
+                    # Starlette found no "bytes" key: a text frame arrived
                     break
+        elif "text" in message:
+            text_data = message["text"]
+            while True:
+                if any(marker in text_data for marker in SIGNALING_MARKERS):
+                    try:
+                        data = orjson.loads(text_data)
+                    except orjson.JSONDecodeError:
+                        log.debug("Received non-JSON text data: %s", text_data)
+                    else:
+                        if isinstance(data, dict) and data.get("type") in SIGNALING_TYPES:
+                            peers = [c for c in manager.active_connections.get(channel, ()) if c is not websocket]
+                            await manager.send_to_all(text_data, peers)
+                        else:
+                            log.debug("Unknown message type in: %s", text_data)
                 else:
-                    raise e
-            if "bytes" in message:
-                data = message["bytes"]
-                print(f"Received data: {len(data)} bytes from {websocket.client} in channel {channel}")
-                if channel in manager.channel_senders and manager.channel_senders[channel] == websocket:
-                    print(f"Broadcasting data from sender: {websocket.client} in channel {channel}")
-                    await manager.broadcast(data, channel, websocket)
-                else:
-                    print(f"Received data from non-sender: {websocket.client} in channel {channel}")
-            elif "text" in message:
-                text_data = message["text"]
+                    log.debug("Dropping non-signaling text data: %s", text_data)
                 try:
-                    data = json.loads(text_data)
-                    if "type" in data:
-                        if data["type"] == "iceCandidate" or data["type"] == "offer" or data["type"] == "answer":
-                            for connection in manager.active_connections[channel]:
-                                if connection != websocket:
-                                    await manager.send_message(text_data, connection)
-                        else:
-                            print(f"Unknown message type: {data['type']}")
-                except json.JSONDecodeError:
-                    print(f"Received non-JSON text data: {text_data}")
+                    text_data = await websocket.receive_text()
+                except KeyError:
+                    # Starlette found no "text" key: a binary frame arrived
+                    break
+        else:
+            # Disconnected before sending a frame
+            return
+        log.info("Closing %s in channel %s: frame type does not match its role", websocket.client, channel)
+        await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA)
     except WebSocketDisconnect:
         manager.disconnect(websocket, channel)
     finally:
         manager.disconnect(websocket, channel)
 
-@app.websocket("/ws/control/{channel}")
-async def websocket_control(websocket: WebSocket, channel: str):
+app.router.add_websocket_route("/ws/{channel}", websocket_endpoint)
+
+NEW_CHANNEL_PREFIX = "new_channel:"
+NEW_CHANNEL_PREFIX_LEN = len(NEW_CHANNEL_PREFIX)
+
+async def _create_channel(new_channel: str):
+    try:
+        db_conn.execute(INSERT_CHANNEL, (new_channel,))
+        db_conn.commit()
+        channels_cache.append(new_channel)
+        connections = tuple(
+            connection
+            for members in manager.active_connections.values()
+            for connection in members
+        )
+        await manager.send_to_all(NEW_CHANNEL_PREFIX + new_channel, connections)
+        log.info("New channel created: %s", new_channel)
+    except sqlite3.IntegrityError:
+        log.info("Channel %s already exists", new_channel)
+
+async def _handle_start(websocket: WebSocket, channel: str):
+    if await manager.set_sender(websocket, channel):
+        await manager.send_message("start_ack", websocket)
+    else:
+        await manager.send_message("busy", websocket)
+
+async def _handle_stop(websocket: WebSocket, channel: str):
+    manager.clear_sender(websocket, channel)
+    await manager.send_message("stop_ack", websocket)
+
+async def _handle_join(websocket: WebSocket, channel: str):
+    peers = [c for c in manager.active_connections.get(channel, ()) if c is not websocket]
+    await manager.send_to_all(f"peer_joined:{websocket.client}", peers)
+
+CONTROL_HANDLERS = {
+    "start": _handle_start,
+    "stop": _handle_stop,
+    "join_channel": _handle_join,
+}
+
+async def websocket_control(websocket: WebSocket):
+    channel = websocket.path_params["channel"]
     await manager.connect(websocket, channel)
+    is_sender = False
     try:
         while True:
             try:
@@ -131,39 +282,25 @@ async def websocket_control(websocket: WebSocket, channel: str):
                     raise e
             if "text" in message:
                 data = message["text"]
-                print(f"Received control message: {data} from {websocket.client} in channel {channel}")
-                if data.startswith("new_channel:"):
-                    new_channel = data.split("new_channel:")[1]
-                    cursor = db_conn.cursor()
-                    try:
-                        cursor.execute("INSERT INTO channels (name) VALUES (?)", (new_channel,))
-                        db_conn.commit()
-                        for active_channel in manager.active_connections:
-                            for connection in manager.active_connections[active_channel]:
-                                await manager.send_message(f"new_channel:{new_channel}", connection)
-                        print(f"New channel created: {new_channel}")
-                    except sqlite3.IntegrityError:
-                        print(f"Channel {new_channel} already exists")
-                elif data == "start":
-                    if await manager.set_sender(websocket, channel):
-                        await manager.send_message("start_ack", websocket)
-                    else:
-                        await manager.send_message("busy", websocket)
-                elif data == "stop":
-                    manager.clear_sender(websocket, channel)
-                    await manager.send_message("stop_ack", websocket)
-                elif data == "join_channel":
-                    for connection in manager.active_connections[channel]:
-                        if connection != websocket:
-                            await manager.send_message(f"peer_joined:{websocket.client}", connection)
+                log.debug("Received control message: %s from %s in channel %s", data, websocket.client, channel)
+                if data[:NEW_CHANNEL_PREFIX_LEN] == NEW_CHANNEL_PREFIX:
+                    await _create_channel(data[NEW_CHANNEL_PREFIX_LEN:])
+                else:
+                    handler = CONTROL_HANDLERS.get(data)
+                    if handler is not None:
+                        await handler(websocket, channel)
+                        is_sender = manager.channel_senders.get(channel) is websocket
             elif "bytes" in message:
                 data = message["bytes"]
-                print(f"Received binary data on control channel: {len(data)} bytes from {websocket.client} in channel {channel}")
-                if channel in manager.channel_senders and manager.channel_senders[channel] == websocket:
-                    await manager.broadcast(data, channel, websocket)
-                else:
-                    print(f"Binary data received from non-sender: {websocket.client} in channel {channel}")
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Received binary data on control channel: %d bytes from %s in channel %s", len(data), websocket.client, channel)
+                    if not is_sender:
+                        log.debug("Binary data received from non-sender: %s in channel %s", websocket.client, channel)
+                if is_sender:
+                    manager.coalesce(data, channel, websocket)
     except WebSocketDisconnect:
         manager.disconnect(websocket, channel)
     finally:
         manager.disconnect(websocket, channel)
+
+app.router.add_websocket_route("/ws/control/{channel}", websocket_control)
@@ -1,13 +1,115 @@
 import asyncio
+import os
+import struct
 import sys
+from functools import lru_cache
 import websockets
 import sounddevice as sd
 import numpy as np
-import queue
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QTextEdit
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QObject
+import threading
+from collections import deque
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QLabel, QPlainTextEdit
+from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal, QObject
+
+try:
+    import uvloop
+except ImportError:
+    # Not available on Windows; the stock asyncio loop works, just slower
+    uvloop = None
+
+try:
+    # Optional Cython build of the frame encoder, see _ws_fast.pyx
+    from _ws_fast import build_masked_binary_frame as compiled_build_frame
+except ImportError:
+    compiled_build_frame = None
 
 BLOCKSIZE = 1024  
+# Lines kept in the log view before the oldest are discarded
+LOG_MAX_LINES = 500
+# How often buffered log lines are appended to the view
+LOG_FLUSH_INTERVAL_MS = 50
+# Seconds without incoming audio before the client stops showing "Receiving..."
+RECEIVE_IDLE_TIMEOUT = 0.2
+# Captured blocks are batched and sent once per interval (seconds)
+TX_FLUSH_INTERVAL = 0.04
+# Unsent bytes allowed in the socket's write buffer (~185 ms of PCM16) before
+# new audio is dropped; stale voice is worse than a gap
+TX_MAX_BUFFERED_BYTES = 16 * 1024
+# Capture buffers preallocated so the audio callback never allocates
+TX_POOL_SIZE = 8
+# Playback ring size in frames (a power of two, ~1.5 s at 44.1 kHz)
+PLAYBACK_RING_FRAMES = 1 << 16
+PLAYBACK_RING_MASK = PLAYBACK_RING_FRAMES - 1
+# Queued playback beyond this many frames is skipped to stay real-time
+PLAYBACK_MAX_FRAMES = 16 * BLOCKSIZE
+# Text frames the server sends in reply to a control message
+CONTROL_REPLIES = frozenset(("start_ack", "busy", "stop_ack"))
+# G.711 mu-law halves audio bandwidth. Off by default: the iOS app and the
+# backend relay expect raw PCM16, so every client in a channel must agree
+USE_ULAW = False
+ULAW_BIAS = 0x84
+ULAW_CLIP = 32635
+
+def ulaw_encode(pcm: bytes) -> bytes:
+    """
+    Encode 16-bit PCM as G.711 mu-law, one byte per sample.
+    Bit-exact with audioop.lin2ulaw, which is deprecated.
+    """
+    samples = np.frombuffer(pcm, dtype=np.int16).astype(np.int32)
+    sign = (samples >> 8) & 0x80
+    # Negative samples are truncated towards -inf at 14 bits, as G.711 does
+    magnitude = np.where(samples < 0, -(samples >> 2) << 2, samples)
+    magnitude = np.minimum(magnitude, ULAW_CLIP) + ULAW_BIAS
+    exponent = np.frexp(magnitude)[1] - 8
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    return (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8).tobytes()
+
+def ulaw_decode(data: bytes) -> np.ndarray:
+    """
+    Decode G.711 mu-law bytes back to int16 samples.
+    """
+    codes = ~np.frombuffer(data, dtype=np.uint8).astype(np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    magnitude = ((((codes & 0x0F) << 3) + ULAW_BIAS) << exponent) - ULAW_BIAS
+    return np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+
+@lru_cache(maxsize=16)
+def frame_header(length: int) -> bytes:
+    """
+    RFC 6455 header for a final, masked, binary frame of the given payload length.
+    """
+    if length < 126:
+        return struct.pack("!BB", 0x82, 0x80 | length)
+    if length < 1 << 16:
+        return struct.pack("!BBH", 0x82, 0x80 | 126, length)
+    return struct.pack("!BBQ", 0x82, 0x80 | 127, length)
+
+def mask_payload(payload: bytes, key: bytes) -> bytes:
+    """
+    XOR payload with the repeating 4-byte key, 8 bytes per operation.
+    """
+    data = np.frombuffer(payload, dtype=np.uint8)
+    masked = np.empty_like(data)
+    key8 = key * 2
+    body = data.size - data.size % 8
+    np.bitwise_xor(
+        data[:body].view(np.uint64),
+        np.frombuffer(key8, dtype=np.uint64)[0],
+        out=masked[:body].view(np.uint64),
+    )
+    # body is a multiple of 8, so the tail starts at key phase 0
+    np.bitwise_xor(data[body:], np.frombuffer(key8, dtype=np.uint8)[:data.size - body], out=masked[body:])
+    return masked.tobytes()
+
+def build_masked_binary_frame(payload: bytes) -> bytes:
+    """
+    Encode payload as a complete client-to-server binary frame, masked with a
+    fresh random key as RFC 6455 requires.
+    """
+    key = os.urandom(4)
+    if compiled_build_frame is not None:
+        return compiled_build_frame(payload, key)
+    return frame_header(len(payload)) + key + mask_payload(payload, key)
 
 class EventLoopThread(QThread):
     """
@@ -16,38 +118,99 @@ class EventLoopThread(QThread):
     def __init__(self):
         super().__init__()
         self.loop = None
+        self.loop_ready = threading.Event()
 
     def run(self):
-        self.loop = asyncio.new_event_loop()
+        self.loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        if sys.version_info >= (3, 12):
+            # Tasks run eagerly up to their first suspension, so short
+            # coroutines finish without a trip through the scheduler
+            self.loop.set_task_factory(asyncio.eager_task_factory)
         asyncio.set_event_loop(self.loop)
+        self.loop_ready.set()
         self.loop.run_forever()
 
     def stop_loop(self):
         if self.loop is not None:
             self.loop.call_soon_threadsafe(self.loop.stop)
 
-class LogEmitter(QObject):
-    log_message = pyqtSignal(str)
+class StatusEmitter(QObject):
+    receiving_changed = pyqtSignal(bool)
 
 class WebSocketClient(QWidget):
     def __init__(self, loop_thread: EventLoopThread):
         super().__init__()
         self.loop_thread = loop_thread
         self.loop = loop_thread.loop
-        self.log_emitter = LogEmitter()
-        self.log_emitter.log_message.connect(self.on_log_message)
+        # Lines logged from any thread; drained into the view by log_timer
+        self.log_buffer = deque()
+        self.log_timer = QTimer(self)
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(LOG_FLUSH_INTERVAL_MS)
+        self.status_emitter = StatusEmitter()
+        self.status_emitter.receiving_changed.connect(self.on_receiving_changed)
         self.initUI()
-        self.uri = "ws://walkietalkie.backend.marijndemul.nl/ws/control"
+        self.uri = "ws://walkietalkie.backend.marijndemul.nl/ws/control/Default"
+        self.websocket = None
+        self.connect_task = None
+        self.receive_task = None
+        # One future per control message awaiting its reply, oldest first; the
+        # server answers control messages in the order they were sent
+        self.control_replies = deque()
         self.is_recording = False
         self.is_receiving = False
+        self.receive_idle_handle = None
+        # Per-packet log lines; off by default, a per-second summary is logged instead
+        self.verbose = False
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.batches_dropped = 0
+        self.reported_sent = 0
+        self.reported_received = 0
+        self.reported_dropped = 0
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.flush_stats)
+        self.stats_timer.start(1000)
 
-        self.audio_queue = queue.Queue()
+        # Single-producer/single-consumer ring: receive_audio writes, the
+        # playback callback reads. The counters only ever grow and are masked
+        # into the ring on use
+        self.playback_ring = np.zeros((PLAYBACK_RING_FRAMES, 1), dtype=np.int16)
+        # Flat view of the same memory, so incoming samples need no reshape
+        self.playback_samples = self.playback_ring.reshape(-1)
+        self.playback_written = 0
+        self.playback_read = 0
+        # Filled by the PortAudio thread, drained by tx_pump; deque append and
+        # popleft are atomic, so neither side takes a lock
+        self.tx_queue = deque()
+        self.tx_pool = deque(bytearray(BLOCKSIZE * 2) for _ in range(TX_POOL_SIZE))
+        self.tx_task = None
+        # Serializes start_recording/stop_recording so a fast release and
+        # re-press reach the server as stop then start. Created on the loop
+        # thread by talk_transition
+        self.talk_lock = None
 
+        # Low latency shrinks PortAudio's buffering at a higher risk of xruns;
+        # both callbacks are allocation-free, which keeps that risk down
         self.output_stream = sd.OutputStream(
             samplerate=44100, channels=1, dtype='int16',
-            blocksize=BLOCKSIZE, callback=self.playback_callback
+            blocksize=BLOCKSIZE, latency='low', callback=self.playback_callback
         )
         self.output_stream.start()
+        # Opened once and left running: opening a PortAudio stream is the
+        # slowest part of a Talk press. Blocks are dropped unless transmitting
+        self.is_transmitting = False
+        self.recording_stream = sd.InputStream(
+            callback=self.audio_callback,
+            channels=1,
+            samplerate=44100,
+            dtype=np.int16,
+            blocksize=BLOCKSIZE,
+            latency='low'
+        )
+        self.recording_stream.start()
+
+        asyncio.run_coroutine_threadsafe(self.connect(), self.loop)
 
     def initUI(self):
         self.setWindowTitle("WebSocket Test Client")
@@ -56,8 +219,9 @@ class WebSocketClient(QWidget):
         self.status_label.setAlignment(Qt.AlignCenter)
         self.status_label.setStyleSheet("font-size: 16px;")
         self.layout.addWidget(self.status_label)
-        self.text_area = QTextEdit(self)
+        self.text_area = QPlainTextEdit(self)
         self.text_area.setReadOnly(True)
+        self.text_area.setMaximumBlockCount(LOG_MAX_LINES)
         self.layout.addWidget(self.text_area)
         self.send_button = QPushButton("Press to Talk", self)
         self.send_button.setStyleSheet("background-color: green; color: white; font-size: 16px; height: 50px;")
@@ -66,54 +230,196 @@ class WebSocketClient(QWidget):
         self.setLayout(self.layout)
 
     def log(self, message: str):
-        self.log_emitter.log_message.emit(message)
+        self.log_buffer.append(message)
 
-    def on_log_message(self, message: str):
-        self.text_area.append(message)
+    def flush_log(self):
+        if self.log_buffer:
+            lines = []
+            while self.log_buffer:
+                lines.append(self.log_buffer.popleft())
+            self.text_area.appendPlainText("\n".join(lines))
 
-    def playback_callback(self, outdata, frames, time, status):
-        try:
-            data = self.audio_queue.get_nowait()
-        except queue.Empty:
-            outdata.fill(0)
+    def flush_stats(self):
+        sent = self.bytes_sent - self.reported_sent
+        received = self.bytes_received - self.reported_received
+        dropped = self.batches_dropped - self.reported_dropped
+        if sent or received or dropped:
+            self.log(
+                f"Audio in the last second: sent {sent} bytes, received {received} bytes, "
+                f"dropped {dropped} batches"
+            )
+        self.reported_sent += sent
+        self.reported_received += received
+        self.reported_dropped += dropped
+
+    def on_receiving_changed(self, receiving: bool):
+        if receiving:
+            self.status_label.setText("Receiving...")
         else:
-            if data.shape[0] < frames:
-                pad_width = frames - data.shape[0]
-                data = np.pad(data, ((0, pad_width), (0, 0)), mode='constant')
-            outdata[:] = data[:frames]
+            self.status_label.setText("Recording..." if self.is_recording else "Idle")
+
+    def set_receiving(self, receiving: bool):
+        self.is_receiving = receiving
+        self.status_emitter.receiving_changed.emit(receiving)
+
+    def mark_receiving(self):
+        """
+        Flag audio as incoming and (re)arm the timer that clears the flag once
+        packets stop arriving. Must be called on the event loop thread.
+        """
+        if not self.is_receiving:
+            self.set_receiving(True)
+        if self.receive_idle_handle is not None:
+            self.receive_idle_handle.cancel()
+        self.receive_idle_handle = self.loop.call_later(RECEIVE_IDLE_TIMEOUT, self.set_receiving, False)
+
+    def playback_callback(self, outdata, frames, time, status):
+        written = self.playback_written
+        read = self.playback_read
+        if written - read > PLAYBACK_MAX_FRAMES:
+            # Fell behind: skip the oldest audio to stay real-time
+            read = written - PLAYBACK_MAX_FRAMES
+        n = min(frames, written - read)
+        start = read & PLAYBACK_RING_MASK
+        first = min(n, PLAYBACK_RING_FRAMES - start)
+        outdata[:first] = self.playback_ring[start:start + first]
+        outdata[first:n] = self.playback_ring[:n - first]
+        outdata[n:].fill(0)
+        self.playback_read = read + n
+
+    def queue_playback(self, samples):
+        """
+        Copy received mono samples into the playback ring. Only the event loop
+        thread writes; the counter is published after the samples, so the audio
+        callback never sees a half-written block and neither side locks.
+        """
+        samples = samples[-PLAYBACK_MAX_FRAMES:]
+        n = samples.size
+        written = self.playback_written
+        start = written & PLAYBACK_RING_MASK
+        first = min(n, PLAYBACK_RING_FRAMES - start)
+        self.playback_samples[start:start + first] = samples[:first]
+        self.playback_samples[:n - first] = samples[first:]
+        self.playback_written = written + n
 
     async def connect(self):
-        self.websocket = await websockets.connect(self.uri)
+        """
+        Make sure the persistent control connection is open, opening it (once,
+        however many callers are waiting) if it never was or has since dropped.
+        Returns False if the server could not be reached.
+        """
+        connection_lost = self.receive_task is None or self.receive_task.done()
+        if self.connect_task is None or (self.connect_task.done() and connection_lost):
+            self.connect_task = asyncio.ensure_future(self.open_connection())
+        return await self.connect_task
+
+    async def open_connection(self):
+        try:
+            # Audio does not deflate, so permessage-deflate only costs CPU per frame
+            self.websocket = await websockets.connect(
+                self.uri, compression=None, max_size=None, ping_interval=20, write_limit=2 ** 20
+            )
+        except Exception as e:
+            self.log(f"Connection failed: {e}")
+            return False
         self.log("Connected to WebSocket (control endpoint)")
+        self.receive_task = asyncio.ensure_future(self.receive_audio())
+        return True
 
     async def send_control_message(self, message):
+        if not await self.connect():
+            return None
         self.log(f"Sending control message: {message}")
-        await self.websocket.send(message)
-        response = await self.websocket.recv()
+        # receive_audio is the connection's only reader and hands the reply over
+        reply = self.loop.create_future()
+        self.control_replies.append(reply)
+        try:
+            await self.websocket.send(message)
+        except Exception:
+            self.control_replies.remove(reply)
+            raise
+        response = await reply
         self.log(f"Control response: {response}")
         return response
 
     async def send_audio(self, audio_data):
-        await self.websocket.send(audio_data)
-        self.log(f"Sent audio data: {len(audio_data)} bytes")
+        # Audio frames are written straight to the connection's transport,
+        # skipping the library's per-send framing and state checks. Going
+        # through the same transport keeps them ordered with control messages.
+        transport = self.websocket.transport
+        # write() raises once the connection has dropped, so audio is discarded
+        # until Talk is released and stop_recording reconnects
+        if transport.is_closing() or transport.get_write_buffer_size() > TX_MAX_BUFFERED_BYTES:
+            self.batches_dropped += 1
+            return
+        transport.write(build_masked_binary_frame(audio_data))
+        self.bytes_sent += len(audio_data)
+        if self.verbose:
+            self.log(f"Sent audio data: {len(audio_data)} bytes")
+
+    async def tx_pump(self):
+        """
+        Send the audio captured since the last flush as a single message every
+        TX_FLUSH_INTERVAL, until transmission stops and the buffer is drained.
+        """
+        while True:
+            await asyncio.sleep(TX_FLUSH_INTERVAL)
+            chunks = []
+            while self.tx_queue:
+                chunks.append(self.tx_queue.popleft())
+            if chunks:
+                batch = b"".join(chunks)
+                for chunk in chunks:
+                    self.tx_pool.append(chunk.obj)
+                if USE_ULAW:
+                    batch = ulaw_encode(batch)
+                await self.send_audio(batch)
+            if not self.is_transmitting:
+                break
+
+    def discard_tx_queue(self):
+        # Blocks left over from an earlier talk burst must not be sent in the next
+        while self.tx_queue:
+            self.tx_pool.append(self.tx_queue.popleft().obj)
+
+    def talk_transition(self):
+        if self.talk_lock is None:
+            self.talk_lock = asyncio.Lock()
+        return self.talk_lock
 
     async def receive_audio(self):
-        while self.is_recording:
+        while True:
             try:
                 message = await self.websocket.recv()
             except Exception as e:
                 self.log(f"Error receiving audio: {e}")
+                while self.control_replies:
+                    reply = self.control_replies.popleft()
+                    if not reply.done():
+                        reply.set_exception(e)
                 break
             if isinstance(message, bytes):
-                if message:
-                    self.log(f"Received {len(message)} bytes of audio data")
-                    audio_data = np.frombuffer(message, dtype=np.int16).reshape(-1, 1)
-                    self.audio_queue.put(audio_data)
-                else:
+                if not message:
                     self.log("Received empty audio data")
+                elif len(message) & 1 and not USE_ULAW:
+                    self.log(f"Dropped odd-length PCM16 message: {len(message)} bytes")
+                else:
+                    self.bytes_received += len(message)
+                    if self.verbose:
+                        self.log(f"Received {len(message)} bytes of audio data")
+                    if USE_ULAW:
+                        samples = ulaw_decode(message)
+                    else:
+                        samples = np.frombuffer(message, dtype=np.int16)
+                    self.queue_playback(samples)
+                    self.mark_receiving()
             elif isinstance(message, str):
-                self.log(f"Received text message (control): {message}")
-            await asyncio.sleep(0.01)
+                if message in CONTROL_REPLIES and self.control_replies:
+                    reply = self.control_replies.popleft()
+                    if not reply.done():
+                        reply.set_result(message)
+                else:
+                    self.log(f"Received text message (control): {message}")
 
     def toggle_recording(self):
         self.is_recording = not self.is_recording
@@ -129,47 +435,54 @@ class WebSocketClient(QWidget):
             asyncio.run_coroutine_threadsafe(self.stop_recording(), self.loop)
 
     async def start_recording(self):
-        try:
-            await self.connect()
-        except Exception as e:
-            self.log(f"Connection failed: {e}")
-            return
-        response = await self.send_control_message("start")
-        if response == "start_ack":
-            self.recording_stream = sd.InputStream(
-                callback=self.audio_callback,
-                channels=1,
-                samplerate=44100,
-                dtype=np.int16,
-                blocksize=BLOCKSIZE
-            )
-            self.recording_stream.start()
-            self.log("Started recording")
-            asyncio.ensure_future(self.receive_audio())
-        else:
-            self.log("Failed to set sender")
+        async with self.talk_transition():
+            response = await self.send_control_message("start")
+            if response == "start_ack":
+                if not self.is_recording:
+                    # Talk was released before the server answered; the queued
+                    # stop_recording clears the sender
+                    return
+                self.discard_tx_queue()
+                self.is_transmitting = True
+                self.log("Started recording")
+                self.tx_task = asyncio.ensure_future(self.tx_pump())
+            else:
+                self.log("Failed to set sender")
 
     async def stop_recording(self):
-        if hasattr(self, "recording_stream"):
-            self.recording_stream.stop()
-        self.log("Stopped recording")
-        try:
-            await self.send_control_message("stop")
-        except Exception as e:
-            self.log(f"Error sending stop message: {e}")
+        async with self.talk_transition():
+            self.is_transmitting = False
+            self.log("Stopped recording")
+            if self.tx_task is not None:
+                try:
+                    await self.tx_task
+                except Exception as e:
+                    self.log(f"Error sending audio: {e}")
+                finally:
+                    self.tx_task = None
+            self.discard_tx_queue()
+            try:
+                await self.send_control_message("stop")
+            except Exception as e:
+                self.log(f"Error sending stop message: {e}")
 
     def audio_callback(self, indata, frames, time, status):
-        if self.is_recording:
-            audio_data = indata.tobytes()
-            self.log(f"Captured audio data: {len(audio_data)} bytes")
-            asyncio.run_coroutine_threadsafe(self.send_audio(audio_data), self.loop)
+        if self.is_transmitting:
+            size = indata.nbytes
+            try:
+                buf = self.tx_pool.popleft()
+            except IndexError:
+                buf = bytearray(BLOCKSIZE * 2)
+            if len(buf) < size:
+                buf = bytearray(size)
+            np.copyto(np.frombuffer(buf, dtype=np.int16, count=indata.size).reshape(indata.shape), indata)
+            self.tx_queue.append(memoryview(buf)[:size])
 
 if __name__ == "__main__":
     loop_thread = EventLoopThread()
     loop_thread.start()
     app = QApplication(sys.argv)
-    while loop_thread.loop is None:
-        pass
+    loop_thread.loop_ready.wait()
     client = WebSocketClient(loop_thread)
     client.show()
     exit_code = app.exec_()